@@ -20,15 +20,18 @@ class Evaluate:
         >>> evaluate = Evaluate()
         >>> benchmark = evaluate.read_benchmark("example-benchmark.tsv")
         >>> sorted(benchmark.items())
-        [('animated film', {1, 3, 4}), ('short film', {3, 4})]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [('animated film', frozenset({1, 3, 4})),
+         ('short film', frozenset({3, 4}))]
         """
-        benchmarks = []
+        benchmarks = {}
         with open(file_name, "r", encoding = "utf8") as file:
             for line in file:
                 line = line.strip()
                 query, documents = line.split("\t", 1)
-                benchmarks.append((query, [int(x) for x in documents.split()]))
-                    
+                ids = np.fromstring(documents, sep=" ", dtype=np.int32)
+                benchmarks[query] = frozenset(ids.tolist())
+
         return benchmarks
                 
 
@@ -58,13 +61,53 @@ class Evaluate:
         MPR = []
         MAP = []
         
-        for query, relevant_ids in benchmark:
+        all_metrics = self._all_metrics
+        for query, relevant_ids in benchmark.items():
             result_ids = ii.process_query(query, use_refinements)
-            MP3.append(self.precision_at_k(result_ids, relevant_ids, 3))
-            MPR.append(self.precision_at_k(result_ids, relevant_ids, len(relevant_ids)))
-            MAP.append(self.average_precision(result_ids, relevant_ids))
+            p_at_3, p_at_r, ap = all_metrics(result_ids, relevant_ids,
+                                             len(relevant_ids))
+            MP3.append(p_at_3)
+            MPR.append(p_at_r)
+            MAP.append(ap)
         return [sum(MP3)/len(MP3), sum(MPR)/len(MPR), sum(MAP)/len(MAP)]
-            
+
+    def _all_metrics(self, result_ids, relevant_ids, R, k=3):
+        """
+        Compute P@k, P@R and AP for the given list of result ids and the given
+        set of R relevant document ids in a single pass over the result list.
+
+        >>> evaluator = Evaluate()
+        >>> evaluator._all_metrics([7, 17, 9, 42, 5], {5, 7, 12, 42}, 4)
+        (0.3333333333333333, 0.5, 0.525)
+        """
+        if R == 0:
+            return 0, 0, 0
+
+        hits = 0
+        hits_at_k = None
+        hits_at_r = None
+        precision_sum = 0
+        for i, a in enumerate(result_ids):
+            if a in relevant_ids:
+                hits += 1
+                precision_sum += hits / (i + 1)
+            if i == k - 1:
+                hits_at_k = hits
+            if i == R - 1:
+                hits_at_r = hits
+            # Once all relevant ids are found, every further position is a
+            # miss.
+            if hits == R:
+                break
+
+        # Positions not reached (the result list is shorter, or all relevant
+        # ids were found before) add no further hits.
+        if hits_at_k is None:
+            hits_at_k = hits
+        if hits_at_r is None:
+            hits_at_r = hits
+        p_at_k = hits_at_k / k if k > 0 else 0
+        return p_at_k, hits_at_r / R, precision_sum / R
 
     def precision_at_k(self, result_ids, relevant_ids, k):
         """
@@ -83,11 +126,8 @@ class Evaluate:
         >>> evaluator.precision_at_k([5, 3, 6, 1, 2], {1, 2, 5, 6, 7, 8}, k=8)
         0.5
         """
-        precision = 0
-        for a in result_ids[:k]:
-            if a in relevant_ids:
-                precision +=1
-        return precision/k
+        return self._all_metrics(result_ids, relevant_ids,
+                                 len(relevant_ids), k)[0]
 
     def average_precision(self, result_ids, relevant_ids):
         """
@@ -102,21 +142,8 @@ class Evaluate:
         >>> evaluator.average_precision([7, 17, 9, 42, 5], {5, 7, 12, 42})
         0.525
         """
-        R_list = []
-        relevant_ids = set(relevant_ids)
-        for a in relevant_ids:
-            if a in result_ids:
-                R_list.append(result_ids.index(a))
-        result = []
-        for a in R_list:
-            result.append(self.precision_at_k(result_ids, relevant_ids, a+1))
-        if len(result) != 0: 
-            return sum(result)/len(relevant_ids) 
-        else:
-            return 0
-            
-        
-                
+        return self._all_metrics(result_ids, relevant_ids,
+                                 len(relevant_ids))[2]
 
 
 def main():
@@ -1,7 +1,56 @@
 import re
 import sys
 #import readline  # NOQA
-import math
+
+import functools
+import itertools
+import multiprocessing
+from collections import Counter
+
+import numpy as np
+
+_WORD_RE = re.compile(r"[A-Za-z]+")
+
+
+def _index_lines(shard):
+    """
+    Compute the docs and the inverted lists with tf scores for a shard of the
+    dataset, given as (id of its first doc, list of its lines as bytes). Used
+    by InvertedIndex.build_from_file, possibly in a worker process.
+
+    Returns (docs, words, dfs, doc_ids, tfs), where the tf lists of all words
+    are stored back to back in the arrays doc_ids and tfs, and the list of
+    words[i] consists of the next dfs[i] entries. Arrays are cheap to send
+    back from a worker process, unlike one Python tuple per posting.
+    """
+    first_doc_id, lines = shard
+    docs = []
+    inverted_lists = {}
+
+    # Bind the methods used per line and per word to locals once.
+    find_words = _WORD_RE.findall
+    add_doc = docs.append
+    get_list = inverted_lists.setdefault
+    for doc_id, line in enumerate(lines, start=first_doc_id):
+        line = line.decode("utf8").strip()
+
+        # Store the doc as a tuple (title, description).
+        title, description, _ = line.split("\t", 2)
+        words = find_words(line.lower())
+        add_doc((title, description, len(words)))
+
+        for word, tf in Counter(words).items():
+            get_list(word, []).append((doc_id, tf))
+
+    words = list(inverted_lists)
+    postings = [inverted_lists[word] for word in words]
+    dfs = np.fromiter(map(len, postings), dtype=np.int64, count=len(words))
+    pairs = np.fromiter(itertools.chain.from_iterable(
+        itertools.chain.from_iterable(postings)),
+        dtype=np.uint32, count=2 * dfs.sum()).reshape(-1, 2)
+    doc_ids = np.ascontiguousarray(pairs[:, 0])
+    tfs = np.ascontiguousarray(pairs[:, 1])
+    return docs, words, dfs, doc_ids, tfs
 
 
 class InvertedIndex:
@@ -9,22 +58,73 @@ class InvertedIndex:
     A simple inverted index that uses BM25 scores.
     """
 
-    def __init__(self):
+    def __init__(self, max_df_ratio=None):
         """
-        Creates an empty inverted index.
+        Creates an empty inverted index. If max_df_ratio is given, words that
+        occur in more than this fraction of all documents (like "the" or "of")
+        are not indexed.
         """
 
-        self.inverted_lists = {}  # The inverted lists of doc ids.
+        self._new_query_cache()
+        self.max_df_ratio = max_df_ratio
+        self.inverted_lists = {}  # The inverted lists (doc_ids, scores).
         self.docs = []  # The docs, each in form (title, description).
+        self.doc_lens = np.zeros(0, dtype=np.uint32)  # The DL of each doc.
+        self.B = np.zeros(0, dtype=np.float32)  # k * (1 - b + b * DL/AVDL).
+        self.max_scores = {}  # The maximal BM25 score in each inverted list.
         self.avdoclen = 0
 
-    def build_from_file(self, file_name, b=0.75, k=1.75):
+    def _new_query_cache(self):
+        """
+        Create the cache of process_query results, keyed by (words,
+        use_refinements, top_k). Each result is stored as a uint32 array, so
+        even a full ranking of all docs takes only 4 bytes per doc.
+        """
+        self._process_query_cached = functools.lru_cache(maxsize=128)(
+            self._process_words)
+
+    # The cached query results depend on the inverted lists and their maximal
+    # scores, so assigning either of them clears the cache. Changing the dicts
+    # in place is not detected.
+
+    @property
+    def inverted_lists(self):
+        return self._inverted_lists
+
+    @inverted_lists.setter
+    def inverted_lists(self, inverted_lists):
+        self._inverted_lists = inverted_lists
+        self._process_query_cached.cache_clear()
+
+    @property
+    def max_scores(self):
+        return self._max_scores
+
+    @max_scores.setter
+    def max_scores(self, max_scores):
+        self._max_scores = max_scores
+        self._process_query_cached.cache_clear()
+
+    def __getstate__(self):
+        """
+        Pickle the index without its query cache.
+        """
+        state = self.__dict__.copy()
+        del state["_process_query_cached"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._new_query_cache()
+
+    def build_from_file(self, file_name, b=0.75, k=1.75, num_workers=1):
         """
         Construct the inverted index from the given file. The expected format
         of the file is one document per line, in the format
         <title>TAB<description>TAB<num_ratings>TAB<rating>TAB<num_sitelinks>
-        Each entry in the inverted list associated to a word should contain a
-        document id and a BM25 score. Compute the BM25 scores as follows:
+        The inverted list associated to a word is stored as a pair of parallel
+        arrays (doc_ids, bm25_scores), sorted by doc id. Compute the BM25
+        scores as follows:
 
         (1) In a first pass, compute the inverted lists with tf scores (that
             is the number of occurrences of the word within the <title> and the
@@ -38,10 +138,36 @@ class InvertedIndex:
             where N is the total number of documents and df is the number of
             documents that contain the word.
 
+        Words whose df exceeds max_df_ratio * N are dropped before (2). If
+        num_workers > 1, pass (1) is split across that many processes, which
+        gives the same index:
+
+        >>> serial = InvertedIndex()
+        >>> serial.build_from_file("example.tsv")
+        >>> parallel = InvertedIndex()
+        >>> parallel.build_from_file("example.tsv", num_workers=2)
+        >>> parallel.docs == serial.docs
+        True
+        >>> sorted(parallel.inverted_lists) == sorted(serial.inverted_lists)
+        True
+        >>> all(np.array_equal(ids, serial.inverted_lists[w][0]) and
+        ...     np.array_equal(scores, serial.inverted_lists[w][1])
+        ...     for w, (ids, scores) in parallel.inverted_lists.items())
+        True
+
+        An empty file gives an empty index, also with several processes:
+
+        >>> import tempfile
+        >>> with tempfile.NamedTemporaryFile(suffix=".tsv") as empty:
+        ...     parallel.build_from_file(empty.name, num_workers=2)
+        >>> parallel.docs, parallel.inverted_lists
+        ([], {})
+
         >>> ii = InvertedIndex()
         >>> ii.build_from_file("example.tsv", b=0, k=float("inf"))
         >>> inv_lists = sorted(ii.inverted_lists.items())
-        >>> [(w, [(i, '%.3f' % tf) for i, tf in l]) for w, l in inv_lists]
+        >>> [(w, [(i, '%.3f' % tf) for i, tf in zip(ids.tolist(), scores)])
+        ...  for w, (ids, scores) in inv_lists]
         ... # doctest: +NORMALIZE_WHITESPACE
         [('animated', [(1, '0.415'), (2, '0.415'), (4, '0.415')]),
          ('animation', [(3, '2.000')]),
@@ -53,7 +179,8 @@ class InvertedIndex:
         >>> ii = InvertedIndex()
         >>> ii.build_from_file("example.tsv", b=0.75, k=1.75)
         >>> inv_lists = sorted(ii.inverted_lists.items())
-        >>> [(w, [(i, '%.3f' % tf) for i, tf in l]) for w, l in inv_lists]
+        >>> [(w, [(i, '%.3f' % tf) for i, tf in zip(ids.tolist(), scores)])
+        ...  for w, (ids, scores) in inv_lists]
         ... # doctest: +NORMALIZE_WHITESPACE
         [('animated', [(1, '0.459'), (2, '0.402'), (4, '0.358')]),
          ('animation', [(3, '2.211')]),
@@ -63,164 +190,260 @@ class InvertedIndex:
          ('short', [(3, '1.106'), (4, '1.313')])]
         """
 
-        with open(file_name, "r", encoding="utf8") as file:
-            doc_id = 0
-            for line in file:
-                line = line.strip()
+        # Read the whole file at once and split it into lines in one call.
+        with open(file_name, "rb") as file:
+            lines = file.read().splitlines()
 
-                doc_id += 1
+        if num_workers > 1 and len(lines) > 1:
+            # Index shards of consecutive lines in parallel. imap returns the
+            # shards in order, so the doc ids of each word stay sorted.
+            shard_size = -(-len(lines) // num_workers)
+            shards = [(i + 1, lines[i:i + shard_size])
+                      for i in range(0, len(lines), shard_size)]
+            with multiprocessing.Pool(num_workers) as pool:
+                results = list(pool.imap(_index_lines, shards))
+        else:
+            results = [_index_lines((1, lines))]
 
-                # Store the doc as a tuple (title, description).
-                title, description, _ = line.split("\t", 2)
-                self.docs.append((title, description, len (re.split("[^A-Za-z]+", line))))
+        # Number the words across all shards and tag each posting with the
+        # number of its word.
+        docs = []
+        vocabulary = {}
+        word_ids = []
+        for shard_docs, shard_words, shard_dfs, _, _ in results:
+            docs.extend(shard_docs)
+            shard_word_ids = np.fromiter(
+                (vocabulary.setdefault(word, len(vocabulary))
+                 for word in shard_words),
+                dtype=np.int64, count=len(shard_words))
+            word_ids.append(np.repeat(shard_word_ids, shard_dfs))
+        word_ids = np.concatenate(word_ids)
+        doc_ids = np.concatenate([result[3] for result in results])
+        tfs = np.concatenate([result[4] for result in results])
 
-                for word in re.split("[^A-Za-z]+", line):
-                    word = word.lower().strip()
+        # Group the postings by word. The sort is stable, so the doc ids of
+        # each word stay sorted. A single shard is already grouped.
+        if len(results) > 1:
+            order = np.argsort(word_ids, kind="stable")
+            word_ids = word_ids[order]
+            doc_ids = doc_ids[order]
+            tfs = tfs[order]
+        words = list(vocabulary)
+        dfs = np.bincount(word_ids, minlength=len(words))
 
-                    # Ignore the word if it is empty.
-                    if len(word) == 0:
-                        continue
+        if self.max_df_ratio is not None:
+            keep = dfs <= self.max_df_ratio * len(docs)
+            postings_kept = keep[word_ids]
+            doc_ids, tfs = doc_ids[postings_kept], tfs[postings_kept]
+            words = [word for word, kept in zip(words, keep) if kept]
+            dfs = dfs[keep]
 
-                    if word not in self.inverted_lists:
-                        # The word is seen for first time, create a new list.
-                        self.inverted_lists[word] = [[doc_id, 1]]
-                    elif self.inverted_lists[word][-1][0] != doc_id:
-                        # Make sure that the list contains the id at most once.
-                        self.inverted_lists[word].append([doc_id, 1])
-                    elif self.inverted_lists[word][-1][0] == doc_id:
-                        self.inverted_lists[word][-1][1] += 1
-        
-        
-        for doc in self.docs:
-            self.avdoclen = self.avdoclen + doc[2]
-            
-        self.avdoclen = self.avdoclen/len(self.docs)    
-            
-        for word in self.inverted_lists:
-            self.bm25tf(k, b, word)
-            self.bm25(k, b, word)
-            
-                
-                
-        # TODO: add your code to compute BM25 scores
-    def bm25tf(self, k1, b, term):
-        for doc in self.inverted_lists[term]:
-            
-            doc_id = doc[0] - 1
-            #print(term)
-            #print(doc)
-            tf = b * self.docs[doc_id][2] / self.avdoclen
-            tf = 1 - b + tf
-            tf = k1 * tf
-            tf = tf + doc[1]
-            tf = doc[1] * (k1 + 1) / tf
-            doc[1] = tf
-    
-    
-    def bm25(self, k1, b, term):
+        # All tf lists are stored back to back in the two contiguous arrays
+        # (doc_ids, tfs); the list of the i-th word is at
+        # offsets[i]:offsets[i + 1].
+        offsets = np.concatenate([[0], np.cumsum(dfs)])
+        tfs = tfs.astype(np.float32)
+        self.docs = docs
+
+        self.doc_lens = np.asarray([doc[2] for doc in self.docs],
+                                   dtype=np.uint32)
+        self.avdoclen = (self.doc_lens.mean(dtype=np.float32)
+                         if len(self.docs) > 0 else np.float32(0))
+        dl = self.doc_lens.astype(np.float32)
+        self.B = np.float32(k) * (1 - np.float32(b)
+                                  + np.float32(b) * dl / self.avdoclen)
+
+        # Compute the BM25 scores of all postings in one go.
         N = len(self.docs)
-        n = len(self.inverted_lists[term])
-        IDF = math.log2((N-n+0.5)/(n+0.5) + 1)
-        
-        for doc in self.inverted_lists[term]:
-            doc[1] = doc[1]*IDF
-            
-        
-        
-    def merge(self, list1, list2):
+        idfs = np.log2((N - dfs + 0.5) / (dfs + 0.5) + 1).astype(np.float32)
+        scores = self.bm25tf(k, doc_ids, tfs)
+        scores *= np.repeat(idfs, dfs)
+        max_scores = np.maximum.reduceat(scores, offsets[:-1])
+
+        # The inverted lists are views into the contiguous arrays.
+        self.inverted_lists = {}
+        for i, word in enumerate(words):
+            start, end = offsets[i], offsets[i + 1]
+            self.inverted_lists[word] = (doc_ids[start:end], scores[start:end])
+        self.max_scores = dict(zip(words, max_scores))
+
+    def bm25tf(self, k1, doc_ids, tfs):
         """
-        Compute the union of the two given inverted lists in linear time
-        (linear in the total number of entries in the two lists), where the
-        entries in the inverted lists are postings of form (doc_id, bm25_score)
-        and are expected to be sorted by doc_id, in ascending order.
+        Compute tf * (k1+1) / (k1 * (1 - b + b * DL/AVDL) + tf) for the given
+        postings, where the denominator factor is precomputed per document in
+        self.B.
+        """
+        return tfs * np.float32(k1 + 1) / (self.B[doc_ids - 1] + tfs)
+
+    def merge(self, ids1, scores1, ids2, scores2):
+        """
+        Compute the union of the two given inverted lists, where each list is
+        given as parallel arrays of doc ids (sorted in ascending order) and
+        BM25 scores. The scores of doc ids contained in both lists are summed
+        up. Returns the union as a pair of arrays (doc_ids, scores).
 
         >>> ii = InvertedIndex()
-        >>> l1 = ii.merge([(1, 2.1), (5, 3.2)], [(1, 1.7), (2, 1.3), (6, 3.3)])
-        >>> [(id, "%.1f" % tf) for id, tf in l1]
+        >>> def postings(l):
+        ...     return np.array([i for i, _ in l], dtype=np.uint32), \\
+        ...            np.array([s for _, s in l], dtype=np.float32)
+        >>> def show(ids, scores):
+        ...     return [(i, "%.1f" % s) for i, s in zip(ids.tolist(), scores)]
+        >>> l1 = ii.merge(*postings([(1, 2.1), (5, 3.2)]),
+        ...               *postings([(1, 1.7), (2, 1.3), (6, 3.3)]))
+        >>> show(*l1)
         [(1, '3.8'), (2, '1.3'), (5, '3.2'), (6, '3.3')]
 
-        >>> l2 = ii.merge([(3, 1.7), (5, 3.2), (7, 4.1)], [(1, 2.3), (5, 1.3)])
-        >>> [(id, "%.1f" % tf) for id, tf in l2]
+        >>> l2 = ii.merge(*postings([(3, 1.7), (5, 3.2), (7, 4.1)]),
+        ...               *postings([(1, 2.3), (5, 1.3)]))
+        >>> show(*l2)
         [(1, '2.3'), (3, '1.7'), (5, '4.5'), (7, '4.1')]
 
-        >>> l2 = ii.merge([], [(1, 2.3), (5, 1.3)])
-        >>> [(id, "%.1f" % tf) for id, tf in l2]
+        >>> l2 = ii.merge(*postings([]), *postings([(1, 2.3), (5, 1.3)]))
+        >>> show(*l2)
         [(1, '2.3'), (5, '1.3')]
 
-        >>> l2 = ii.merge([(1, 2.3)], [])
-        >>> [(id, "%.1f" % tf) for id, tf in l2]
+        >>> l2 = ii.merge(*postings([(1, 2.3)]), *postings([]))
+        >>> show(*l2)
         [(1, '2.3')]
 
-        >>> l2 = ii.merge([], [])
-        >>> [(id, "%.1f" % tf) for id, tf in l2]
+        >>> l2 = ii.merge(*postings([]), *postings([]))
+        >>> show(*l2)
         []
         """
-        
-        union = []
-        cursor1 = 0
-        cursor2 = 0
-        endpoint1 = len(list1)
-        endpoint2 = len(list2)
-
-        while cursor2 < endpoint2 and cursor1 < endpoint1:
-            while list2[cursor2][0] < list1[cursor1][0]:
-                union.append(list2[cursor2])
-                cursor2 += 1
-                #print(cursor2, 2)
-                if cursor2>= endpoint2:
-                    return union
-            if list2[cursor2][0] == list1[cursor1][0]:
-                union.append([list2[cursor2][0], list1[cursor1][1]+list2[cursor2][1]])
-                #print(intersection)
-                
-            if list2[cursor2][0] > list1[cursor1][0]:
-                union.append(list1[cursor1])
-                #print(intersection)    
-            cursor1 += 1
-            
-            #print(cursor1, 1)
-        return union
-        
-        
-    def process_query(self, query, use_refinements=False):
+        ids = np.concatenate([ids1, ids2])
+        scores = np.concatenate([scores1, scores2])
+        if len(ids) == 0:
+            return ids, scores
+
+        order = np.argsort(ids, kind="stable")
+        ids = ids[order]
+        scores = scores[order]
+
+        # Sum up the scores of each run of equal doc ids.
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(ids)) + 1])
+        return ids[starts], np.add.reduceat(scores, starts)
+
+    def process_query(self, query, use_refinements=False, top_k=None):
         """
         Process the given keyword query as follows: fetch the inverted list for
         each of the keywords in the query and compute the union of all lists.
         Sort the resulting list by BM25 scores in descending order.
 
         This method returns _all_ results for the given query, not just the
-        top 3!
+        top 3! If top_k is given, only the top_k best results are returned
+        (none if top_k <= 0), and inverted lists that cannot change them are
+        skipped (see max_score_top_k).
 
         If you want to implement some ranking refinements, make these
         refinements optional (their use should be controllable via the
         use_refinements flag).
 
         >>> ii = InvertedIndex()
+        >>> def postings(ids, scores):
+        ...     return (np.array(ids, dtype=np.uint32),
+        ...             np.array(scores, dtype=np.float32))
         >>> ii.inverted_lists = {
-        ... "foo": [(1, 0.2), (3, 0.6)],
-        ... "bar": [(1, 0.4), (2, 0.7), (3, 0.5)],
-        ... "baz": [(2, 0.1)]}
-        >>> result = ii.process_query(["foo", "bar"], use_refinements=False)
-        >>> [(id, "%.1f" % tf) for id, tf in result]
-        [(3, '1.1'), (2, '0.7'), (1, '0.6')]
-        """
-        keywords = re.split("[^A-Za-z]+", query)
-        if keywords[0] in self.inverted_lists:
-            union = self.inverted_lists[keywords[0]]
+        ... "foo": postings([1, 3], [0.2, 0.6]),
+        ... "bar": postings([1, 2, 3], [0.4, 0.7, 0.5]),
+        ... "baz": postings([2], [0.1])}
+        >>> ii.process_query("foo bar", use_refinements=False)
+        [3, 2, 1]
+        >>> ii.process_query("bar foo FOO", use_refinements=False)
+        [3, 2, 1]
+        >>> ii.max_scores = {w: scores.max()
+        ...                  for w, (_, scores) in ii.inverted_lists.items()}
+        >>> ii.process_query("foo bar", use_refinements=False, top_k=2)
+        [3, 2]
+        >>> ii.process_query("foo bar", use_refinements=False, top_k=0)
+        []
+
+        Assigning new inverted lists invalidates the cached results:
+
+        >>> ii.inverted_lists = {"foo": postings([5], [0.3]),
+        ...                      "bar": postings([5, 6], [0.1, 0.5])}
+        >>> ii.process_query("foo bar", use_refinements=False)
+        [6, 5]
+        """
+        # Each distinct keyword counts once, keywords without an inverted
+        # list are ignored. The sorted words also serve as cache key.
+        keywords = set(_WORD_RE.findall(query.lower()))
+        words = tuple(sorted(word for word in keywords
+                             if word in self.inverted_lists))
+        if len(words) == 0 or (top_k is not None and top_k <= 0):
+            return []
+        return self._process_query_cached(words, use_refinements,
+                                          top_k).tolist()
+
+    def _process_words(self, words, use_refinements, top_k):
+        """
+        Compute the result of process_query for the given tuple of distinct
+        words that all have an inverted list. Returns a read-only array of
+        doc ids.
+        """
+        if top_k is not None:
+            doc_ids = np.asarray(self.max_score_top_k(words, top_k),
+                                 dtype=np.uint32)
         else:
-            union = []
-        for key in keywords:
-            if  key in self.inverted_lists:
-                union = self.merge(union, self.inverted_lists[key])
-            else:
-                union = []
-                
-        sorted_union = sorted(union, key=lambda x: x[1], reverse=True)
-        
-        sorted_pages = []
-        for page in sorted_union:
-            sorted_pages.append(page[0])
-        return sorted_pages
+            union = (np.zeros(0, dtype=np.uint32),
+                     np.zeros(0, dtype=np.float32))
+            for word in words:
+                union = self.merge(*union, *self.inverted_lists[word])
+
+            ids, scores = union
+            doc_ids = ids[np.argsort(-scores, kind="stable")]
+        doc_ids.setflags(write=False)
+        return doc_ids
+
+    def max_score_top_k(self, words, top_k):
+        """
+        Compute the top_k results for the given words with MaxScore pruning:
+        merge the inverted lists in decreasing order of their maximal score.
+        As soon as the k-th best score so far exceeds the sum of the maximal
+        scores of the remaining lists, no further doc can make it into the
+        top_k, so the remaining lists are only used to complete the scores of
+        the docs seen so far.
+
+        >>> ii = InvertedIndex()
+        >>> def postings(ids, scores):
+        ...     return (np.array(ids, dtype=np.uint32),
+        ...             np.array(scores, dtype=np.float32))
+        >>> ii.inverted_lists = {
+        ... "foo": postings([1, 3], [2.2, 2.6]),
+        ... "bar": postings([1, 2, 3, 4], [0.4, 0.7, 0.5, 0.1])}
+        >>> ii.max_scores = {w: scores.max()
+        ...                  for w, (_, scores) in ii.inverted_lists.items()}
+        >>> ii.max_score_top_k(["bar", "foo"], 2)
+        [3, 1]
+        >>> ii.max_score_top_k(["bar", "foo"], 3)
+        [3, 1, 2]
+        """
+        words = sorted(words, key=lambda word: -self.max_scores[word])
+        remaining = sum(float(self.max_scores[word]) for word in words)
+
+        doc_ids = np.zeros(0, dtype=np.uint32)
+        scores = np.zeros(0, dtype=np.float32)
+        for i, word in enumerate(words):
+            if len(doc_ids) >= top_k:
+                threshold = np.partition(scores, -top_k)[-top_k]
+                if threshold > remaining:
+                    for other in words[i:]:
+                        ids, other_scores = self.inverted_lists[other]
+                        pos = np.searchsorted(ids, doc_ids)
+                        pos[pos == len(ids)] = 0
+                        hits = ids[pos] == doc_ids
+                        scores[hits] += other_scores[pos[hits]]
+                    break
+            doc_ids, scores = self.merge(doc_ids, scores,
+                                         *self.inverted_lists[word])
+            remaining -= float(self.max_scores[word])
+
+        # Only sort the docs with a score of at least the k-th best score.
+        if len(doc_ids) > top_k:
+            threshold = np.partition(scores, -top_k)[-top_k]
+            top = scores >= threshold
+            doc_ids, scores = doc_ids[top], scores[top]
+        order = np.lexsort((doc_ids, -scores))[:top_k]
+        return doc_ids[order].tolist()
 
         
 def main():
@@ -242,7 +465,7 @@ def main():
     
     while True:
         input1 = input("Input keywords to search for:")
-        union = ii.process_query(input1)
+        union = ii.process_query(input1, top_k=3)
         if len(union) != 0:
             for page in union[:3]:
                 print("Title: " + ii.docs[page - 1][0])